@@ -16,6 +16,8 @@ from torch.cuda.amp import grad_scaler as gs
 from helpers import logger
 from helpers.console_util import log_module_info
 from helpers.metrics_util import compute_metrics, MetricsAggregator
+from helpers import checkpoint_util
+from helpers.checkpoint_util import AsyncSaver
 from algos.classification.models import ClassifierModelTenChan
 
 
@@ -36,6 +38,8 @@ class Classifier(object):
         self.iters_so_far = 0
         self.epochs_so_far = 0
 
+        self.saver = AsyncSaver()  # for the periodic checkpoints
+
         if self.hps.clip_norm <= 0:
             logger.info(f"clip_norm={self.hps.clip_norm} <= 0, hence disabled.")
 
@@ -52,22 +56,27 @@ class Classifier(object):
             lr=self.hps.lr,
         )
 
+        # bf16 has the exponent range of fp32 hence does not need loss scaling
+        self.amp_dtype = torch.bfloat16 if self.hps.amp_dtype == 'bf16' else torch.float16
+
         self.ctx = (
             torch.amp.autocast(
                 device_type='cuda',
-                dtype=torch.float16 if self.hps.fp16 else torch.float32,
+                dtype=self.amp_dtype if self.hps.fp16 else torch.float32,
             )
             if self.hps.cuda
             else nullcontext()
         )
 
-        self.scaler = gs.GradScaler(enabled=self.hps.fp16)
+        self.scaler = gs.GradScaler(enabled=(self.hps.fp16 and self.amp_dtype == torch.float16))
 
         self.metrics = MetricsAggregator(
             self.hps.num_classes,
             self.hps.batch_size,
         )
 
+        self.val_balances = None  # built from the val dataloader on the first epoch
+
         log_module_info(logger, 'classifier_model', self.model)
 
     def compute_loss(self, x, true_y):
@@ -94,17 +103,19 @@ class Classifier(object):
             itertools.chain.from_iterable(itertools.repeat(val_dataloader)),
             strict=False,
         )
-        balances = torch.Tensor(val_dataloader.balances)
-        if self.hps.cuda:
-            balances = balances.pin_memory().to(self.device, non_blocking=True)
-        else:
-            balances = balances.to(self.device)
+        if self.val_balances is None:  # the val set is the same across epochs: build once
+            self.val_balances = torch.as_tensor(val_dataloader.balances, dtype=torch.float32)
+            if self.hps.cuda:
+                self.val_balances = self.val_balances.pin_memory().to(
+                    self.device, non_blocking=True)
+            else:
+                self.val_balances = self.val_balances.to(self.device)
 
         for i, ((t_x, t_true_y), (v_x, v_true_y)) in enumerate(agg_iterable):
 
             if self.hps.cuda:
-                t_x = t_x.pin_memory().to(self.device, non_blocking=True)
-                t_true_y = t_true_y.pin_memory().to(self.device, non_blocking=True)
+                t_x = t_x.to(self.device, non_blocking=True)
+                t_true_y = t_true_y.to(self.device, non_blocking=True)
             else:
                 t_x, t_true_y = t_x.to(self.device), t_true_y.to(self.device)
 
@@ -136,8 +147,8 @@ class Classifier(object):
                 with torch.no_grad():
 
                     if self.hps.cuda:
-                        v_x = v_x.pin_memory().to(self.device, non_blocking=True)
-                        v_true_y = v_true_y.pin_memory().to(self.device, non_blocking=True)
+                        v_x = v_x.to(self.device, non_blocking=True)
+                        v_true_y = v_true_y.to(self.device, non_blocking=True)
                     else:
                         v_x, v_true_y = v_x.to(self.device), v_true_y.to(self.device)
 
@@ -147,7 +158,7 @@ class Classifier(object):
                         v_pred_y = (v_pred_y >= 0.).long()
                         v_metrics.update(compute_metrics(
                             v_pred_y, v_true_y,
-                            weights=balances,
+                            weights=self.val_balances,
                         ))
                         self.metrics.step(v_pred_y, v_true_y)
 
@@ -164,7 +175,7 @@ class Classifier(object):
 
     def test(self, dataloader):
 
-        balances = torch.Tensor(dataloader.balances)
+        balances = torch.as_tensor(dataloader.balances, dtype=torch.float32)
         if self.hps.cuda:
             balances = balances.pin_memory().to(self.device, non_blocking=True)
         else:
@@ -177,8 +188,8 @@ class Classifier(object):
             for i, (x, true_y) in enumerate(tqdm(dataloader)):
 
                 if self.hps.cuda:
-                    x = x.pin_memory().to(self.device, non_blocking=True)
-                    true_y = true_y.pin_memory().to(self.device, non_blocking=True)
+                    x = x.to(self.device, non_blocking=True)
+                    true_y = true_y.to(self.device, non_blocking=True)
                 else:
                     x, true_y = x.to(self.device), true_y.to(self.device)
 
@@ -197,23 +208,30 @@ class Classifier(object):
 
         self.send_to_dash(self.metrics.compute(), step_metric=0, glob='test-agg')
 
-    def save_to_path(self, path, xtra=None):
+    def save_to_path(self, path, xtra=None, blocking=True, wait_pending=True):
         suffix = f"model_{self.epochs_so_far}"
         if xtra is not None:
             suffix += f"_{xtra}"
         suffix += ".tar"
         path = Path(path) / suffix
-        torch.save({
+        checkpoint = {
             'hps': self.hps,
             'iters_so_far': self.iters_so_far,
             'epochs_so_far': self.epochs_so_far,
             # state_dict's
             'model_state_dict': self.model.state_dict(),
             'opt_state_dict': self.opt.state_dict(),
-        }, path)
+        }
+        # save the checkpoint to filesystem
+        if blocking:
+            if wait_pending:
+                self.saver.wait()  # let the pending background saves land first
+            torch.save(checkpoint, path)
+        else:
+            self.saver.submit(checkpoint, path)
 
     def load_from_path(self, path):
-        checkpoint = torch.load(path)
+        checkpoint = checkpoint_util.load(path, map_location=self.device)
         if 'iters_so_far' in checkpoint:
             self.iters_so_far = checkpoint['iters_so_far']
         if 'epochs_so_far' in checkpoint:
@@ -46,8 +46,8 @@ class LARSWrapper(object):
     def load_state_dict(self, state_dict):
         self.opt.load_state_dict(state_dict)
 
-    def zero_grad(self):
-        self.opt.zero_grad()
+    def zero_grad(self, set_to_none=True):
+        self.opt.zero_grad(set_to_none=set_to_none)
 
     def add_param_group(self, param_group):
         self.opt.add_param_group(param_group)
@@ -15,8 +15,11 @@ from torch.cuda.amp import grad_scaler as gs
 
 from helpers import logger
 from helpers.console_util import log_module_info
-from helpers.metrics_util import compute_metrics, MetricsAggregator
+from helpers.metrics_util import MetricsAggregator, threshold_and_count
 from helpers.model_util import add_weight_decay
+from helpers.dataloader_utils.cuda_prefetcher import CUDAPrefetcher
+from helpers import checkpoint_util
+from helpers.checkpoint_util import AsyncSaver
 from algos.ssl.models import SimCLRModel
 from algos.ssl.ntx_ent_loss import NTXentLoss
 from algos.ssl.lars import LARSWrapper
@@ -39,6 +42,15 @@ class SimCLR(object):
         self.iters_so_far = 0
         self.epochs_so_far = 0
 
+        self.saver = AsyncSaver()  # for the periodic checkpoints
+
+        # buffer of what is sent to wandb (one dict per send), flushed every `log_every` sends
+        self._log_buf = []
+
+        # decide once how tensors are sent to device: async copies only make sense
+        # for (pinned) host-to-cuda transfers
+        self.non_blocking = bool(self.hps.cuda)
+
         if self.hps.clip_norm <= 0:
             logger.info(f"clip_norm={self.hps.clip_norm} <= 0, hence disabled.")
 
@@ -49,6 +61,9 @@ class SimCLR(object):
             fc_out_dim=self.hps.fc_out_dim,
         ).to(self.device)
 
+        # materialized once for grad clipping
+        self._clip_params = [p for p in self.model.parameters() if p.requires_grad]
+
         self.criterion = NTXentLoss(temperature=self.hps.ntx_temp).to(self.device)
 
         if not self.hps.lars:  # if not set to use layerwise lr adaption
@@ -84,16 +99,19 @@ class SimCLR(object):
                 T_max=800,
             )  # "decay the learning rate with the cosine decay schedule without restarts"
 
+        # bf16 has the exponent range of fp32 hence does not need loss scaling
+        self.amp_dtype = torch.bfloat16 if self.hps.amp_dtype == 'bf16' else torch.float16
+
         self.ctx = (
             torch.amp.autocast(
                 device_type='cuda',
-                dtype=torch.float16 if self.hps.fp16 else torch.float32,
+                dtype=self.amp_dtype if self.hps.fp16 else torch.float32,
             )
             if self.hps.cuda
             else nullcontext()
         )
 
-        self.scaler = gs.GradScaler(enabled=self.hps.fp16)
+        self.scaler = gs.GradScaler(enabled=(self.hps.fp16 and self.amp_dtype == torch.float16))
 
         if self.hps.load_checkpoint is not None:
             self.already_loaded = False
@@ -115,17 +133,26 @@ class SimCLR(object):
 
         log_module_info(logger, 'simclr_model', self.model)
 
+        # compiled forward passes are kept aside from `self.model`, which the checkpoints
+        # and the head renewal keep using (the compiled wrapper would prefix the state_dict)
+        self.model_fwd = self.model
+        if self.hps.cuda and self.hps.compile:
+            self.model_fwd = torch.compile(self.model, mode='max-autotune', fullgraph=False)
+            self.criterion = torch.compile(self.criterion)
+            logger.info("model and criterion compiled (first steps will be slow)")
+
+    def _to_device(self, t):
+        return t.to(self.device, non_blocking=self.non_blocking)
+
     def compute_loss(self, x_i, x_j):
-        z_i, z_j = self.model(x_i, x_j)  # positive pair
+        z_i, z_j = self.model_fwd(x_i, x_j)  # positive pair
         loss = self.criterion(z_i, z_j)
-        metrics = {'loss': loss.item()}
+        metrics = {'loss': loss.detach()}  # stays on device; synced only when sent to dash
         return metrics, loss
 
     def send_to_dash(self, metrics, *, step_metric, glob):
-        wandb_dict = {
-            f"{glob}/{k}": v.item() if hasattr(v, 'item') else v
-            for k, v in metrics.items()
-        }
+        # values kept as they are (possibly on device) until the flush, to defer the syncs
+        wandb_dict = {f"{glob}/{k}": v for k, v in metrics.items()}
         if glob == 'train':
             wandb_dict[f"{glob}/lr"] = (
                 self.sched.get_last_lr()[0]  # current lr if using scheduler
@@ -135,30 +162,39 @@ class SimCLR(object):
         wandb_dict[f"{glob}/step"] = step_metric
         wandb_dict['epoch'] = self.epochs_so_far
 
-        wandb.log(wandb_dict)
-        logger.info(f"logged this to wandb: {wandb_dict}")
+        self._log_buf.append(wandb_dict)
+        if len(self._log_buf) >= self.hps.log_every:
+            self.flush_dash()
+
+    def flush_dash(self):
+        for wandb_dict in self._log_buf:  # every send is logged, in order
+            wandb_dict = {k: v.item() if hasattr(v, 'item') else v for k, v in wandb_dict.items()}
+            wandb.log(wandb_dict)
+            if logger.debug_enabled():  # spares the formatting of the whole dict otherwise
+                logger.debug(f"logged this to wandb: {wandb_dict}")
+        self._log_buf = []
 
     def train(self, train_dataloader, val_dataloader):
 
-        agg_iterable = zip(
-            tqdm(train_dataloader),
-            itertools.chain.from_iterable(itertools.repeat(val_dataloader)),
-            strict=False,
-        )
+        t_iterable = train_dataloader
+        v_iterable = itertools.chain.from_iterable(itertools.repeat(val_dataloader))
+        if self.hps.cuda:
+            # copy the next batches on a side stream while the current ones are processed
+            t_iterable = CUDAPrefetcher(t_iterable, self.device)
+            v_iterable = CUDAPrefetcher(v_iterable, self.device)
 
-        for i, ((t_x, _), (v_x, _)) in enumerate(agg_iterable):
+        v_iter = None  # only created (and pulled from) when evaluating
 
-            t_x_i, t_x_j = [e.squeeze() for e in torch.tensor_split(t_x, 2, dim=1)]  # unpack
+        for i, (t_x, _) in enumerate(tqdm(t_iterable)):
 
-            if self.hps.cuda:
-                t_x_i = t_x_i.pin_memory().to(self.device, non_blocking=True)
-                t_x_j = t_x_j.pin_memory().to(self.device, non_blocking=True)
-            else:
-                t_x_i, t_x_j = t_x_i.to(self.device), t_x_j.to(self.device)
+            t_x_i, t_x_j = t_x.unbind(dim=1)  # unpack
+
+            # no-op on cuda, where the prefetcher already moved the batch
+            t_x_i, t_x_j = self._to_device(t_x_i), self._to_device(t_x_j)
 
             with self.ctx:
                 t_metrics, t_loss = self.compute_loss(t_x_i, t_x_j)
-                t_loss /= self.hps.acc_grad_steps
+                t_loss = t_loss / self.hps.acc_grad_steps  # out-of-place: logged loss unchanged
 
             t_loss: Any = self.scaler.scale(t_loss)  # silly trick to bypass broken
             # torch.cuda.amp type hints (issue: https://github.com/pytorch/pytorch/issues/108629)
@@ -167,12 +203,13 @@ class SimCLR(object):
             if ((i + 1) % self.hps.acc_grad_steps == 0) or (i + 1 == len(train_dataloader)):
 
                 if self.hps.clip_norm > 0:
-                    self.scaler.unscale_(self.opt)
-                    cg.clip_grad_norm_(self.model.parameters(), self.hps.clip_norm)
+                    if self.scaler.is_enabled():  # grads are only scaled with fp16
+                        self.scaler.unscale_(self.opt)
+                    cg.clip_grad_norm_(self._clip_params, self.hps.clip_norm)
 
                 self.scaler.step(self.opt)
                 self.scaler.update()
-                self.opt.zero_grad()
+                self.opt.zero_grad(set_to_none=True)
 
                 self.send_to_dash(t_metrics, step_metric=self.iters_so_far, glob='train')
                 del t_metrics
@@ -183,13 +220,13 @@ class SimCLR(object):
 
                 with torch.no_grad():
 
-                    v_x_i, v_x_j = [e.squeeze() for e in torch.tensor_split(v_x, 2, dim=1)]
+                    if v_iter is None:
+                        v_iter = iter(v_iterable)
+                    v_x, _ = next(v_iter)
+
+                    v_x_i, v_x_j = v_x.unbind(dim=1)
 
-                    if self.hps.cuda:
-                        v_x_i = v_x_i.pin_memory().to(self.device, non_blocking=True)
-                        v_x_j = v_x_j.pin_memory().to(self.device, non_blocking=True)
-                    else:
-                        v_x_i, v_x_j = v_x_i.to(self.device), v_x_j.to(self.device)
+                    v_x_i, v_x_j = self._to_device(v_x_i), self._to_device(v_x_j)
 
                     with self.ctx:
                         v_metrics, _ = self.compute_loss(v_x_i, v_x_j)
@@ -201,6 +238,8 @@ class SimCLR(object):
 
             self.iters_so_far += 1
 
+        self.flush_dash()
+
         if self.hps.sched:
             self.sched.step()
         self.epochs_so_far += 1
@@ -212,13 +251,9 @@ class SimCLR(object):
 
             for i, (x, _) in enumerate(tqdm(test_dataloader)):
 
-                x_i, x_j = [e.squeeze() for e in torch.tensor_split(x, 2, dim=1)]
+                x_i, x_j = x.unbind(dim=1)
 
-                if self.hps.cuda:
-                    x_i = x_i.pin_memory().to(self.device, non_blocking=True)
-                    x_j = x_j.pin_memory().to(self.device, non_blocking=True)
-                else:
-                    x_i, x_j = x_i.to(self.device), x_j.to(self.device)
+                x_i, x_j = self._to_device(x_i), self._to_device(x_j)
 
                 with self.ctx:
                     metrics, _ = self.compute_loss(x_i, x_j)
@@ -226,6 +261,8 @@ class SimCLR(object):
                 self.send_to_dash(metrics, step_metric=i, glob='test')
                 del metrics
 
+        self.flush_dash()
+
     def renew_head(self):
         # In self-supervised learning, there are two ways to evaluate models:
         # (i) fine-tuning, and (ii) linear evaluation (or "linear probes").
@@ -264,6 +301,9 @@ class SimCLR(object):
         # Replace the entire mlp part of the SimCLR model with the created linear probe
         self.model.fc = self.new_head  # models are mutable like list and dict
 
+        # the model and its trainable params changed, so refresh
+        self._clip_params = [p for p in self.model.parameters() if p.requires_grad]
+
         i = 0
         for n, p in self.model.named_parameters():
             if p.requires_grad:
@@ -301,20 +341,29 @@ class SimCLR(object):
         self.new_ctx = (
             torch.amp.autocast(
                 device_type='cuda',
-                dtype=torch.float16 if self.hps.fp16 else torch.float32,
+                dtype=self.amp_dtype if self.hps.fp16 else torch.float32,
             )
             if self.hps.cuda
             else nullcontext()
         )
 
         # Set up the gradient scaler for fp16 gpu precision
-        self.new_scaler = gs.GradScaler(enabled=self.hps.fp16)
+        self.new_scaler = gs.GradScaler(
+            enabled=(self.hps.fp16 and self.amp_dtype == torch.float16))
 
         self.metrics = MetricsAggregator(
             self.hps.num_classes,
             self.hps.ftop_batch_size,
         )  # no need for any "new" prefix; this is for downstream classifier only
 
+        # fuse the eval post-processing (threshold, cast, counts) into few kernels;
+        # the cuda graphs of 'reduce-overhead' are fine since the batch shape is fixed
+        self.threshold_and_count = (
+            torch.compile(threshold_and_count, mode='reduce-overhead')
+            if self.hps.cuda and self.hps.compile
+            else threshold_and_count
+        )
+
         # Reset the counters
         self.iters_so_far = 0
         self.epochs_so_far = 0
@@ -328,35 +377,30 @@ class SimCLR(object):
     def compute_classifier_loss(self, x, true_y):
         pred_y = self.model(x)
         loss = self.new_criterion(pred_y, true_y)
-        metrics = {'loss': loss}
+        metrics = {'loss': loss.detach()}  # stays on device; synced only when sent to dash
         return metrics, loss, pred_y
 
     def ftop_train(self, train_dataloader, val_dataloader):
         # the code that follows is identical whether we fine-tune or just train the probe
         # because the only thing that changes between the two is the new optimizer (cf. above)
 
-        agg_iterable = zip(
-            tqdm(train_dataloader),
-            itertools.chain.from_iterable(itertools.repeat(val_dataloader)),
-            strict=False,
-        )
-        balances = torch.Tensor(val_dataloader.balances)
+        t_iterable = train_dataloader
+        v_iterable = itertools.chain.from_iterable(itertools.repeat(val_dataloader))
         if self.hps.cuda:
-            balances = balances.pin_memory().to(self.device, non_blocking=True)
-        else:
-            balances = balances.to(self.device)
+            # copy the next batches on a side stream while the current ones are processed
+            t_iterable = CUDAPrefetcher(t_iterable, self.device)
+            v_iterable = CUDAPrefetcher(v_iterable, self.device)
 
-        for i, ((t_x, t_true_y), (v_x, v_true_y)) in enumerate(agg_iterable):
+        v_iter = None  # only created (and pulled from) when evaluating
 
-            if self.hps.cuda:
-                t_x = t_x.pin_memory().to(self.device, non_blocking=True)
-                t_true_y = t_true_y.pin_memory().to(self.device, non_blocking=True)
-            else:
-                t_x, t_true_y = t_x.to(self.device), t_true_y.to(self.device)
+        for i, (t_x, t_true_y) in enumerate(tqdm(t_iterable)):
+
+            # no-op on cuda, where the prefetcher already moved the batch
+            t_x, t_true_y = self._to_device(t_x), self._to_device(t_true_y)
 
             with self.new_ctx:
                 t_metrics, t_loss, _ = self.compute_classifier_loss(t_x, t_true_y)
-                t_loss /= self.hps.acc_grad_steps
+                t_loss = t_loss / self.hps.acc_grad_steps  # out-of-place: logged loss unchanged
 
             t_loss: Any = self.scaler.scale(t_loss)  # silly trick to bypass broken
             # torch.cuda.amp type hints (issue: https://github.com/pytorch/pytorch/issues/108629)
@@ -365,12 +409,13 @@ class SimCLR(object):
             if ((i + 1) % self.hps.acc_grad_steps == 0) or (i + 1 == len(train_dataloader)):
 
                 if self.hps.clip_norm > 0:
-                    self.new_scaler.unscale_(self.new_opt)
-                    cg.clip_grad_norm_(self.model.parameters(), self.hps.clip_norm)
+                    if self.new_scaler.is_enabled():  # grads are only scaled with fp16
+                        self.new_scaler.unscale_(self.new_opt)
+                    cg.clip_grad_norm_(self._clip_params, self.hps.clip_norm)
 
                 self.new_scaler.step(self.new_opt)
                 self.new_scaler.update()
-                self.new_opt.zero_grad()
+                self.new_opt.zero_grad(set_to_none=True)
 
                 self.send_to_dash(t_metrics, step_metric=self.iters_so_far, glob='ftop-train')
                 del t_metrics
@@ -381,21 +426,17 @@ class SimCLR(object):
 
                 with torch.no_grad():
 
-                    if self.hps.cuda:
-                        v_x = v_x.pin_memory().to(self.device, non_blocking=True)
-                        v_true_y = v_true_y.pin_memory().to(self.device, non_blocking=True)
-                    else:
-                        v_x, v_true_y = v_x.to(self.device), v_true_y.to(self.device)
+                    if v_iter is None:
+                        v_iter = iter(v_iterable)
+                    v_x, v_true_y = next(v_iter)
+
+                    v_x, v_true_y = self._to_device(v_x), self._to_device(v_true_y)
 
                     with self.ctx:
                         v_metrics, _, v_pred_y = self.compute_classifier_loss(v_x, v_true_y)
-                        # compute evaluation scores
-                        v_pred_y = (v_pred_y >= 0.).long()
-                        v_metrics.update(compute_metrics(
-                            v_pred_y, v_true_y,
-                            weights=balances,
-                        ))
-                        self.metrics.step(v_pred_y, v_true_y)
+                        # only accumulate the evaluation stats; scores computed once per epoch
+                        self.metrics.add(
+                            v_x.size(dim=0), self.threshold_and_count(v_pred_y, v_true_y))
 
                     self.send_to_dash(
                         v_metrics, step_metric=self.iters_so_far, glob='ftop-val')
@@ -407,6 +448,7 @@ class SimCLR(object):
 
         self.send_to_dash(
             self.metrics.compute(), step_metric=self.epochs_so_far, glob='ftop-val-agg')
+        self.flush_dash()
         self.metrics.reset()
         self.epochs_so_far += 1
 
@@ -414,40 +456,26 @@ class SimCLR(object):
         # the code that follows is identical whether we fine-tune or just train the probe
         # because the only thing that changes between the two is the new optimizer (cf. above)
 
-        balances = torch.Tensor(dataloader.balances)
-        if self.hps.cuda:
-            balances = balances.pin_memory().to(self.device, non_blocking=True)
-        else:
-            balances = balances.to(self.device)
-
         self.model.eval()
 
         with torch.no_grad():
 
             for i, (x, true_y) in enumerate(tqdm(dataloader)):
 
-                if self.hps.cuda:
-                    x = x.pin_memory().to(self.device, non_blocking=True)
-                    true_y = true_y.pin_memory().to(self.device, non_blocking=True)
-                else:
-                    x, true_y = x.to(self.device), true_y.to(self.device)
+                x, true_y = self._to_device(x), self._to_device(true_y)
 
                 with self.ctx:
                     metrics, _, pred_y = self.compute_classifier_loss(x, true_y)
-                    # compute evaluation scores
-                    pred_y = (pred_y >= 0.).long()
-                    metrics.update(compute_metrics(
-                        pred_y, true_y,
-                        weights=balances,
-                    ))
-                    self.metrics.step(pred_y, true_y)
+                    # only accumulate the evaluation stats; scores computed once at the end
+                    self.metrics.add(x.size(dim=0), self.threshold_and_count(pred_y, true_y))
 
                 self.send_to_dash(metrics, step_metric=i, glob='ftop-test')
                 del metrics
 
         self.send_to_dash(self.metrics.compute(), step_metric=0, glob='ftop-test-agg')
+        self.flush_dash()
 
-    def save_to_path(self, path, xtra=None):
+    def save_to_path(self, path, xtra=None, blocking=True, wait_pending=True):
         suffix = f"model_{self.epochs_so_far}"
         if xtra is not None:
             suffix += f"_{xtra}"
@@ -466,10 +494,15 @@ class SimCLR(object):
                 'sched_state_dict': self.sched.state_dict(),
             })
         # save the checkpoint to filesystem
-        torch.save(checkpoint, path)
+        if blocking:
+            if wait_pending:
+                self.saver.wait()  # let the pending background saves land first
+            torch.save(checkpoint, path)
+        else:
+            self.saver.submit(checkpoint, path)
 
     def load_from_path(self, path):
-        checkpoint = torch.load(path)
+        checkpoint = checkpoint_util.load(path, map_location=self.device)
         if 'iters_so_far' in checkpoint:
             self.iters_so_far = checkpoint['iters_so_far']
         if 'epochs_so_far' in checkpoint:
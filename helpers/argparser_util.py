@@ -41,6 +41,18 @@ def agg_argparser():
         parser, "fp16", default=False,
         help="whether to use fp16 precision",
     )
+    parser.add_argument(
+        "--amp_dtype", type=str, choices=['fp16', 'bf16'], default='fp16',
+        help="half-precision dtype used by autocast when fp16 is set (bf16 needs no grad scaler)",
+    )
+    boolean_flag(
+        parser, "deterministic", default=False,
+        help="whether to use deterministic cudnn algos (no autotuning, no tf32)",
+    )
+    boolean_flag(
+        parser, "compile", default=False,
+        help="whether to torch.compile the model (opt-in: slow first steps)",
+    )
     # logging
     parser.add_argument(
         "--wandb_project", default='DEFAULT',
@@ -77,6 +89,10 @@ def agg_argparser():
     parser.add_argument(
         "--eval_every", type=int, default=100,
     )
+    parser.add_argument(
+        "--log_every", type=int, default=1,
+        help="number of sends to the dashboard buffered before logging them all to wandb",
+    )
     # opt
     parser.add_argument(
         "--lr", type=float, default=3e-4,
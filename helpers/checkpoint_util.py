@@ -0,0 +1,67 @@
+import inspect
+import queue
+import threading
+
+import torch
+
+from helpers import logger
+
+
+def to_cpu(obj):
+    """Recursively copy every tensor of a (nested) state dict into fresh cpu memory,
+    so that the copy is not affected by the training steps that follow.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        out = type(obj)((k, to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            out._metadata = obj._metadata  # module state dicts carry versions in there
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+# `mmap` only exists from torch 2.1 on; older versions hand unknown keywords to the unpickler
+_LOAD_KWARGS = {'mmap': True} if 'mmap' in inspect.signature(torch.load).parameters else {}
+
+
+def load(path, map_location):
+    """Load a checkpoint straight onto `map_location`, memory-mapping the file (instead of
+    reading it whole) when torch supports it.
+    Not weights-only because the checkpoint also holds the hps namespace.
+    """
+    return torch.load(path, map_location=map_location, weights_only=False, **_LOAD_KWARGS)
+
+
+class AsyncSaver(object):
+    """Writes checkpoints to disk from a background thread.
+    A save submitted while `maxsize` saves are already pending is dropped (and a
+    warning is logged): such saves are meant for periodic, non-critical checkpoints.
+    """
+
+    def __init__(self, maxsize=2):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            checkpoint, path = self.queue.get()
+            try:
+                torch.save(checkpoint, path)
+            except Exception as e:
+                logger.error(f"background save to {path} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def submit(self, checkpoint, path):
+        if self.queue.full():  # checked first to spare the copy
+            logger.warn(f"too many pending saves; dropping the one to {path}")
+            return
+        self.queue.put_nowait((to_cpu(checkpoint), path))
+
+    def wait(self):
+        """Block until every pending save has been written"""
+        self.queue.join()
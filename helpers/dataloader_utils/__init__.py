@@ -1,3 +1,4 @@
+import os
 from pathlib import Path, PurePath
 from typing import List, Union
 
@@ -7,14 +8,13 @@ def path2str(path: Path) -> str:
 
 
 def read_from_file(path: Union[str, Path], parent: str = "") -> List[str]:
-    content = []
-    with Path(path).open("r") as f:
-        content = f.readlines()
-    content = [
-        str(PurePath(parent).joinpath(line.strip()))
-        for line in content if len(line.strip()) > 0
-    ]
-    return content
+    # read in bulk, and join with plain strings: no path object per line (there are many)
+    content = Path(path).read_text().splitlines()
+    content = [line.strip() for line in content]
+    if len(parent) == 0:
+        return [line for line in content if len(line) > 0]
+    prefix = str(PurePath(parent)) + os.sep  # normalized once
+    return [prefix + line for line in content if len(line) > 0]
 
 
 def save2file(filepath: Path, content: List[str]) -> None:
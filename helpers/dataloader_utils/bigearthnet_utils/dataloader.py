@@ -17,7 +17,9 @@ class BigEarthNetDataloader(DataLoader):
         """Overwrite because relays the method of the `Dataset` class otherwise"""
         if self.batch_size is None:
             raise ValueError(f"invalid batch size ({self.batch_size}); can't be None!")
-        return math.ceil(self.dataset_length // self.batch_size)
+        if self.drop_last:
+            return self.dataset_length // self.batch_size
+        return math.ceil(self.dataset_length / self.batch_size)  # last partial batch counted
 
 
 def get_dataloader(
@@ -35,8 +37,19 @@ def get_dataloader(
     memory: bool = False,
     num_workers: int = 0,
     shuffle: bool = False,
+    pin_memory: bool = False,
+    persistent_workers: bool = False,
 ):
 
+    worker_kwargs = {}
+    if num_workers > 0:  # these options are only valid with worker processes
+        worker_kwargs.update({
+            # no worker respawn at every epoch, but the (leaking, see below) workers stay
+            # alive as long as the dataloader does: only for the ones iterated every epoch
+            'persistent_workers': persistent_workers,
+            'prefetch_factor': 4,  # batches loaded in advance by each worker
+        })
+
     if dataset_handle == 'bigearthnet':
         dataloader = BigEarthNetDataloader(
             BigEarthNetDataset(
@@ -56,6 +69,8 @@ def get_dataloader(
             num_workers=num_workers,  # a value of 0 plugs the memory leak (can't avoid using Python lists)
             shuffle=shuffle,
             drop_last=True,
+            pin_memory=pin_memory,  # batches come out pinned, ready for async h2d copies
+            **worker_kwargs,
         )
         return dataloader
     else:
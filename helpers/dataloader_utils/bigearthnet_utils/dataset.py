@@ -57,9 +57,11 @@ class BigEarthNetDataset(Dataset):
         self.bands = bands
         self.memory = memory
 
+        content = read_from_file(self.split_path, parent=data_path)
+
         if self.train_stage:
             assert 0 < truncate_at <= 100
-            tot_len = len(read_from_file(self.split_path, data_path))
+            tot_len = len(content)
             self.truncate_at = int(
                 (truncate_at / 100.) * tot_len
             )  # transform the % to keep into the # of samples to keep
@@ -69,7 +71,6 @@ class BigEarthNetDataset(Dataset):
                 f"i.e. PERC={int(self.truncate_at) / tot_len * 100.}%"
             )  # sanity check
 
-        content = read_from_file(self.split_path, parent=data_path)
         if self.train_stage:  # truncate if asked, but only for the training set
             all_the_is = np.arange(0, len(content))
             self.is2keep = np.random.default_rng(seed).choice(
@@ -90,7 +91,10 @@ class BigEarthNetDataset(Dataset):
             self.data = self.read_data(self.folder_path_list)
 
         if self.with_labels:
-            self.labels = np.array(self.get_labels_as_multi_hot_vector())  # always load in memory whole
+            self.labels = np.array(
+                self.get_labels_as_multi_hot_vector(),
+                dtype=np.float32,  # the dtype the labels are consumed in, to avoid casts later
+            )  # always load in memory whole
             logger.info("we compute and plot the imbalance-ness now")
             n_samples, n_classes = self.labels.shape
             self.balances = self.labels.sum(axis=0) / n_samples
@@ -206,9 +210,9 @@ class BigEarthNetDataset(Dataset):
         data_np = np.array(data)
         del data
         if len(data_np) == 1:
-            return torch.Tensor(data_np[0])
+            return torch.as_tensor(data_np[0])  # no copy: already float32
         else:
-            return torch.Tensor(data_np)
+            return torch.as_tensor(data_np)
 
     def __len__(self) -> int:
         """Returns number of instances in dataset."""
@@ -219,7 +223,7 @@ class BigEarthNetDataset(Dataset):
     ) -> Union[Tuple[Union[torch.Tensor, List[torch.Tensor]], torch.Tensor], Union[torch.Tensor, List[torch.Tensor]]]:
 
         if self.memory:
-            data = torch.Tensor(self.data[index])
+            data = self.data[index]  # already a tensor
         else:
             data = self.read_data([self.folder_path_list[index]], bands=bands)
 
@@ -232,7 +236,7 @@ class BigEarthNetDataset(Dataset):
             output = data
 
         if self.with_labels:
-            labels_for_output = torch.Tensor(self.labels[index])
+            labels_for_output = torch.as_tensor(self.labels[index])  # no copy: already float32
             return (output, labels_for_output)
         else:
             return output
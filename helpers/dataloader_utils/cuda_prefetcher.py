@@ -0,0 +1,45 @@
+import torch
+
+
+class CUDAPrefetcher(object):
+    """Wraps an iterable of batches (sequences of tensors) and copies the next batch
+    to the device on a side cuda stream while the current batch is being consumed
+    on the main stream, so that the h2d transfer overlaps with compute.
+    The wrapped iterable should yield pinned tensors for the copies to be asynchronous.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.copy_stream = torch.cuda.Stream(device=device)
+        self.batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.copy_stream):
+            self.batch = [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __next__(self):
+        if self.batch is None:
+            raise StopIteration
+        # make the main stream wait for the copy of the batch about to be handed out
+        torch.cuda.current_stream().wait_stream(self.copy_stream)
+        batch = self.batch
+        for t in batch:
+            # the memory was allocated on the side stream but is used on the main one:
+            # without this the caching allocator could hand the buffer back too early
+            t.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
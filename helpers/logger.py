@@ -1,10 +1,15 @@
 import sys
+import atexit
+import functools
+import csv
 from pathlib import Path
 import tempfile
 import json
 import datetime
 from collections import OrderedDict
 
+import numpy as np
+
 
 DEBUG = 10
 INFO = 20
@@ -14,6 +19,16 @@ ERROR = 40
 DISABLED = 50
 
 
+def _truncate(s):
+    return s[:40] + '...' if len(s) > 43 else s
+
+
+@functools.lru_cache(maxsize=4096)
+def _truncate_key(key):
+    # the logged keys are the same from one dump to the next, unlike the values
+    return _truncate(key)
+
+
 class KVWriter(object):
 
     def writekvs(self, kvs):
@@ -30,8 +45,10 @@ class HumanOutputFormat(KVWriter, SeqWriter):
 
     def __init__(self, path_or_textiofilething):
         self.file = path_or_textiofilething
+        self.fh = None
         if isinstance(path_or_textiofilething, Path):
-            self.write_fn = self.file.write_text
+            # `write_text` would reopen and truncate the file at every write
+            self.write_fn = self._append
             self.own_file = True
         else:  # must be a textiofilething or assert error
             assert_msg = (
@@ -41,55 +58,90 @@ class HumanOutputFormat(KVWriter, SeqWriter):
             assert hasattr(self.file, 'write'), assert_msg
             self.write_fn = self.file.write
             self.own_file = False
+        self._key_cache = {}  # ordered key set -> (truncated keys, key column width)
 
     def writekvs(self, kvs):
-        # Create strings for printing
-        key2str = {}
-        for (key, val) in kvs.items():
-            if isinstance(val, float):
-                valstr = f"{val:<8.3g}"
-            else:
-                valstr = str(val)
-            key2str[self._truncate(key)] = self._truncate(valstr)
-
-        # Find max widths
-        if len(key2str) == 0:
+        items = [(key, val) for key, val in kvs.items()
+                 if val is not None]  # registered key not logged since the last dump
+        if len(items) == 0:
             # empty key-value dict; not sending warning nor stopping
             return
-        else:
-            keywidth = max(map(len, key2str.keys()))
-            valwidth = max(map(len, key2str.values()))
 
-        # Write out the data
+        # The key set is usually the same from one dump to the next: truncate it once.
+        # Keyed by the ordered keys (not a frozenset) so that each key stays aligned
+        # with its value when the same keys come in a different order
+        keys = tuple(key for key, _ in items)
+        if keys not in self._key_cache:
+            trunc_keys = [_truncate_key(key) for key in keys]
+            self._key_cache[keys] = (trunc_keys, max(map(len, trunc_keys)))
+        trunc_keys, keywidth = self._key_cache[keys]
+
+        # Create strings for printing
+        valstrs = [_truncate(f"{val:<8.3g}" if isinstance(val, float) else str(val))
+                   for _, val in items]
+        valwidth = max(map(len, valstrs))
+
+        # Write out the data (padding done by the format spec, no throwaway space strings)
         dashes = '-' * (keywidth + valwidth + 7)
         lines = [dashes]
-        for (key, val) in key2str.items():
-            key_space = ' ' * (keywidth - len(key))
-            val_space = ' ' * (valwidth - len(val))
-            lines.append(f"| {key}{key_space} | {val}{val_space} |")
+        lines.extend(f"| {key:<{keywidth}} | {val:<{valwidth}} |"
+                     for key, val in zip(trunc_keys, valstrs, strict=True))
         lines.append(dashes)
         self.write_fn('\n'.join(lines) + '\n')
 
-    def _truncate(self, s):
-        return s[:40] + '...' if len(s) > 43 else s
-
     def writeseq(self, seq):
-        for arg in seq:
-            self.write_fn(arg)
-        self.write_fn('\n')
+        self.write_fn(''.join(seq) + '\n')  # one write per line, not one per token
+
+    def _append(self, s):
+        if self.fh is None:  # opened on first write, then kept open for the whole run
+            # line-buffered: every write ends with a newline, hence is flushed right away
+            # (a SIGKILL following a timeout must not cost the tail of the log)
+            self.fh = self.file.open('a', buffering=1, encoding='utf-8')
+            atexit.register(self.fh.close)
+        self.fh.write(s)
+
+    def flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+        elif hasattr(self.file, 'flush'):
+            self.file.flush()
+
+
+def _jsonable(v):
+    """Turn numpy (and torch) arrays into (possibly nested) lists and their scalars
+    into python scalars; leave anything else as is
+    """
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    # torch is not imported here (the spawner does not need it): a tensor can only
+    # be logged if the caller already imported it
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.is_tensor(v):
+        v = v.detach()
+        return v.item() if v.ndim == 0 else v.cpu().tolist()
+    return v
 
 
 class JSONOutputFormat(KVWriter):
 
     def __init__(self, path):
         self.file = path
+        # open once for the whole run, one json object per line (ndjson)
+        self.fh = self.file.open('a', buffering=1 << 16, encoding='utf-8')
+        atexit.register(self.fh.close)
 
     def writekvs(self, kvs):
-        for k, v in kvs.items():
-            if hasattr(v, 'dtype'):
-                v = v.tolist()
-                kvs[k] = float(v)
-        self.file.write_text(json.dumps(kvs), newline='\n')
+        kvs = {
+            k: _jsonable(v)
+            for k, v in kvs.items()
+            if v is not None  # registered key not logged since the last dump
+        }
+        self.fh.write(json.dumps(kvs, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        self.fh.flush()
 
 
 class CSVOutputFormat(KVWriter):
@@ -98,46 +150,51 @@ class CSVOutputFormat(KVWriter):
         self.file = path
         self.keys = []
         self.sep = ','
+        # open once for the whole run (read access needed to rewrite the header)
+        self.fh = self.file.open('a+', buffering=1 << 16, newline='')
+        atexit.register(self.fh.close)
+        self.writer = csv.writer(self.fh, delimiter=self.sep)
 
     def writekvs(self, kvs):
         # Add our current row to the history
-        extra_keys = kvs.keys() - self.keys
+        extra_keys = [k for k in kvs if k not in self.keys]
         if extra_keys:
             self.keys.extend(extra_keys)
-            with self.file.open() as f:
-                lines = f.readlines()
-            for (i, k) in enumerate(self.keys):
-                if i > 0:
-                    self.file.write_text(',')
-                self.file.write_text(k)
-            self.file.write('\n')
-            for line in lines[1:]:
-                self.file.write_text(line[:-1])
-                self.file.write_text(self.sep * len(extra_keys))
-                self.file.write_text('', newline='\n')
-        for (i, k) in enumerate(self.keys):
-            if i > 0:
-                self.file.write_text(',')
-            v = kvs.get(k)
-            if v:
-                self.file.write_text(str(v))
-        self.file.write_text('', newline='\n')
+            # rewrite the file in one go: new header, then the former rows padded
+            self.fh.seek(0)
+            rows = list(csv.reader(self.fh, delimiter=self.sep))[1:]
+            self.fh.seek(0)
+            self.fh.truncate()
+            self.writer.writerow(self.keys)
+            self.writer.writerows(row + [''] * len(extra_keys) for row in rows)
+        self.writer.writerow(['' if kvs.get(k) is None else kvs[k] for k in self.keys])
+
+    def flush(self):
+        self.fh.flush()
+
+
+# Factories of the output formats, each taking the log directory and a file name suffix
+_FORMATS = {
+    'stdout': lambda dir_, suffix: HumanOutputFormat(sys.stdout),
+    'log': lambda dir_, suffix: HumanOutputFormat(dir_ / f"log{suffix}.txt"),
+    'json': lambda dir_, suffix: JSONOutputFormat(dir_ / f"progress{suffix}.json"),
+    'csv': lambda dir_, suffix: CSVOutputFormat(dir_ / f"progress{suffix}.csv"),
+}
+
+
+def register_format(formatting, factory):
+    """Make a new output format available under the name `formatting`.
+    `factory` is called with the log directory (as a Path) and a file name suffix.
+    """
+    _FORMATS[formatting] = factory
 
 
 def make_output_format(formatting, dir_, suffix=''):
+    if formatting not in _FORMATS:
+        raise ValueError(f"unknown formatting specified: {formatting}")
     dir_ = Path(dir_)
     dir_.mkdir(parents=True, exist_ok=True)
-    match formatting:  # python version >3.10 needed
-        case 'stdout':
-            return HumanOutputFormat(sys.stdout)
-        case 'log':
-            return HumanOutputFormat(dir_ / f"log{suffix}.txt")
-        case 'json':
-            return JSONOutputFormat(dir_ / f"progress{suffix}.json")
-        case 'csv':
-            return CSVOutputFormat(dir_ / f"progress{suffix}.csv")
-        case _:
-            raise ValueError(f"unknown formatting specified: {formatting}")
+    return _FORMATS[formatting](dir_, suffix)
 
 
 # Frontend
@@ -149,10 +206,16 @@ def logkv(key, val):
     Logger.CURRENT.logkv(key, val)
 
 
+def register_keys(keys):
+    """Declare upfront the keys that will be logged with the current logger,
+    so that its key-value dict is built once at its final size.
+    """
+    Logger.CURRENT.register_keys(keys)
+
+
 def logkvs(d):
     """Log a dictionary of key-value pairs with the current logger"""
-    for (k, v) in d.items():
-        logkv(k, v)
+    Logger.CURRENT.logkvs(d)
 
 
 def dumpkvs():
@@ -197,6 +260,17 @@ def set_level(level):
     Logger.CURRENT.set_level(level)
 
 
+def is_enabled_for(level):
+    """Whether a message at `level` would be written by the current logger.
+    Meant to guard call sites so that messages are not even formatted when filtered.
+    """
+    return Logger.CURRENT.is_enabled_for(level)
+
+
+def debug_enabled():
+    return is_enabled_for(DEBUG)
+
+
 def get_dir():
     """Get directory to which log files are being written"""
     return Logger.CURRENT.get_dir()
@@ -220,8 +294,14 @@ class Logger(object):
         self.dir_ = dir_
         self.output_formats = output_formats
 
+    def register_keys(self, keys):
+        self.name2val = OrderedDict.fromkeys(keys)  # all None, i.e. not logged yet
+
     def logkv(self, key, val):
-        self.name2val.update({key: val})
+        self.name2val[key] = val
+
+    def logkvs(self, d):
+        self.name2val.update(d)  # one bulk update rather than one call per pair
 
     def dumpkvs(self):
         if self.level == DISABLED:
@@ -229,13 +309,22 @@ class Logger(object):
         for output_format in self.output_formats:
             if isinstance(output_format, KVWriter):
                 output_format.writekvs(self.name2val)
-        self.name2val.clear()
+            if hasattr(output_format, 'flush'):
+                output_format.flush()  # once per dump, not per write
+        # reset the values but keep the keys (hence the dict capacity) for the next round;
+        # writers skip the None values
+        for key in self.name2val:
+            self.name2val[key] = None
 
     def log(self, *args, level=INFO):
-        if self.level <= level:
+        if not self.is_enabled_for(level):
             # If the current logger level is higher than
             # the `level` argument, don't print to stdout
-            self._log(args)
+            return
+        self._log(args)
+
+    def is_enabled_for(self, level):
+        return self.level != DISABLED and self.level <= level
 
     def set_level(self, level):
         self.level = level
@@ -244,9 +333,10 @@ class Logger(object):
         return self.dir_
 
     def _log(self, args):
+        line = (''.join(map(str, args)),)  # assembled once, whatever the number of writers
         for output_format in self.output_formats:
             if isinstance(output_format, SeqWriter):
-                output_format.writeseq(map(str, args))
+                output_format.writeseq(line)
 
 
 def configure(dir_=None, format_strs=None):
@@ -137,6 +137,28 @@ def compute_metrics(pred_y, true_y, weights):
     return metrics
 
 
+def batch_counts(pred, answer):
+    """Count, over a batch of multi-hot predictions, what MetricsAggregator accumulates:
+    predicted positives, actual positives, matches, true positives, true negatives and
+    fully matching rows, stacked in one tensor (vectorized over labels and rows)
+    """
+    match = (pred == answer)
+    both = pred + answer
+    return torch.stack([
+        pred.sum(),
+        answer.sum(),
+        match.sum(),
+        (both == 2).sum(),
+        (both == 0).sum(),
+        match.all(dim=1).sum(),  # a row counts only if all matching
+    ]).float()
+
+
+def threshold_and_count(logits, answer):
+    # threshold the logits into multi-hot predictions, then count the batch stats
+    return batch_counts((logits >= 0.).long(), answer)
+
+
 class MetricsAggregator(object):
 
     def __init__(self, num_labels, batch_size):
@@ -157,43 +179,23 @@ class MetricsAggregator(object):
 
     def step(self, pred, answer):
         # integrate the stats to the system
+        self.add(pred.size(dim=0), batch_counts(pred, answer))
 
-        # add the new samples to the count
-        self.n += pred.size(dim=0)  # arbitrary
-
-        # loop over every label
-        for i in range(self.num_labels):
-
-            p_i, a_i = pred[:, i], answer[:, i]
-
-            p_i_true = p_i.sum(dim=0)
-            a_i_true = a_i.sum(dim=0)
-            self.tot_p_i_true += p_i_true
-            self.tot_a_i_true += a_i_true
-
-            a_i_false = self.batch_size - a_i_true
-            self.tot_a_i_false += a_i_false
-
-            corr = (
-                p_i == a_i
-            ).sum(dim=0).float()
-            corr_true = (
-                p_i + a_i == 2
-            ).sum(dim=0).float()
-            corr_false = (
-                p_i + a_i == 0
-            ).sum(dim=0).float()
-
-            self.tot_corr += corr
-            self.tot_corr_true += corr_true
-            self.tot_corr_false += corr_false
-
-        for j in range(self.batch_size):
-            # going over the rows now
-
-            p_j, a_j = pred[j, :], answer[j, :]
+    def add(self, n, counts):
+        # integrate stats already counted by `batch_counts` (possibly in a compiled region)
+        # (only made of device-side tensor ops: no host sync until the metrics are read)
 
-            self.tot_subset_corr += (p_j == a_j).prod()  # zero unless all matching
+        # add the new samples to the count
+        self.n += n
+
+        p_true, a_true, corr, corr_true, corr_false, subset_corr = counts.unbind()
+        self.tot_p_i_true += p_true
+        self.tot_a_i_true += a_true
+        self.tot_a_i_false += (n * self.num_labels) - a_true
+        self.tot_corr += corr
+        self.tot_corr_true += corr_true
+        self.tot_corr_false += corr_false
+        self.tot_subset_corr += subset_corr
 
     def compute(self):
         if self.n == 0:
@@ -31,8 +31,17 @@ def run(args):
     if args.cuda:
         # Use cuda
         assert torch.cuda.is_available()
-        cudnn.benchmark = False
-        cudnn.deterministic = True
+        if args.deterministic:
+            cudnn.benchmark = False
+            cudnn.deterministic = True
+        else:
+            # the input shape is fixed (10x120x120): let cudnn autotune its conv algorithms
+            cudnn.benchmark = True
+            cudnn.deterministic = False
+            # allow tf32 (ampere+) for the matmuls and convs still carried out in fp32
+            torch.backends.cuda.matmul.allow_tf32 = True
+            cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision('high')
         device = torch.device("cuda:0")
     else:
         if torch.has_mps:
@@ -1,10 +1,10 @@
 import time
+import hashlib
 import os
 import signal
 from pathlib import Path
 
 import wandb
-import numpy as np
 
 from helpers import logger
 from helpers.console_util import timed_cm_wrapper, log_epoch_info
@@ -12,12 +12,36 @@ from helpers.dataloader_utils.bigearthnet_utils.dataloader import get_dataloader
 from helpers.dataloader_utils.bigearthnet_utils.splitter import split_dataset
 
 
-debug_lvl = os.environ.get('DEBUG_LVL', 0)
-try:
-    debug_lvl = np.clip(int(debug_lvl), a_min=0, a_max=3)
-except ValueError:
-    debug_lvl = 0
-DEBUG = bool(debug_lvl >= 1)
+def _debug_enabled():
+    """Read the debug level from the environment (no work at import time)"""
+    try:
+        debug_lvl = max(0, min(3, int(os.environ.get('DEBUG_LVL', 0))))
+    except ValueError:
+        debug_lvl = 0
+    return debug_lvl >= 1
+
+
+def init_wandb(args, experiment_name, group, max_attempts=6):
+    """Connect to wandb, retrying with an exponential backoff (bounded, in attempts and pause)"""
+    for attempt in range(max_attempts):
+        try:
+            wandb.init(
+                project=args.wandb_project,
+                name=experiment_name,
+                id=experiment_name,
+                group=group,
+                config=args.__dict__,
+                dir=args.root,
+            )
+            break
+        except Exception:
+            if attempt == max_attempts - 1:
+                logger.error(f"wandb co error. Giving up after {max_attempts} attempts.")
+                raise
+            pause = min(2 ** attempt, 60)
+            logger.info(f"wandb co error. Retrying in {pause} secs.")
+            time.sleep(pause)
+    logger.info("wandb co established!")
 
 
 def learn(
@@ -29,14 +53,14 @@ def learn(
 ):
 
     # Create context manager that records the time taken by encapsulated ops
-    timed = timed_cm_wrapper(logger, use=DEBUG)
+    timed = timed_cm_wrapper(logger, use=_debug_enabled())
 
     with timed("splitting"):
         paths_list = split_dataset(args.dataset_handle, args.num_classes)
 
     with timed("dataloading"):
-        dataloaders = []
-        tmpdict = {
+        # Arguments shared by all the dataloaders
+        loader_kwargs = {
             "num_classes": args.num_classes,
             "seed": args.seed,
             "data_path": args.data_path,
@@ -46,53 +70,25 @@ def learn(
             "with_labels": with_labels,
             "truncate_at": args.truncate_at,
             "num_workers": args.num_workers,
+            "pin_memory": args.cuda,
         }
-        # Create the dataloaders
-        dataloaders.append(get_dataloader(
-            **tmpdict, split_path=paths_list[0], train_stage=True, shuffle=True,
-        ))
-        dataloaders.append(get_dataloader(
-            **tmpdict, split_path=paths_list[1],
-        ))
-        dataloaders.append(get_dataloader(
-            **tmpdict, split_path=paths_list[2],
-        ))
-
-        for i, e in enumerate(dataloaders):
-            # Log stats about the dataloaders
-            ds_len = e.dataset_length
-            dl_len = len(e)
-            logger.info(
-                f"DATALOADER#{i} -|-"
-                f"SETLEN={str(ds_len).zfill(7)} -|-"
-                f"DLDLEN={str(dl_len).zfill(7)}"
-            )
-
-        dataloaders_2 = []  # to avoid unboundedness
-        if args.linear_probe or args.fine_tuning:
-            tmpdict = {
-                "num_classes": args.num_classes,
-                "seed": args.seed,
-                "data_path": args.data_path,
-                "dataset_handle": args.dataset_handle,
-                "batch_size": args.ftop_batch_size,
-                "num_transforms": 1,
-                "with_labels": with_labels,
-                "truncate_at": args.truncate_at,
-                "num_workers": args.num_workers,
-            }
-            # Create the dataloaders
-            dataloaders_2.append(get_dataloader(
-                **tmpdict, split_path=paths_list[0], train_stage=True, shuffle=True,
-            ))
-            dataloaders_2.append(get_dataloader(
-                **tmpdict, split_path=paths_list[1],
-            ))
-            dataloaders_2.append(get_dataloader(
-                **tmpdict, split_path=paths_list[2],
-            ))
-
-            for i, e in enumerate(dataloaders_2):
+        # Arguments specific to the train, val and test dataloaders respectively
+        # (only the ones iterated every epoch keep their workers alive in between)
+        split_kwargs = (
+            {"split_path": paths_list[0], "train_stage": True, "shuffle": True,
+             "persistent_workers": True},
+            {"split_path": paths_list[1], "persistent_workers": True},
+            {"split_path": paths_list[2]},
+        )
+
+        def make_dataloaders(**overrides):
+            # Create the dataloaders, one after the other: each dataset logs a report
+            # (label file, kept samples, class imbalance) that must not interleave
+            dls = [
+                get_dataloader(**{**loader_kwargs, **overrides, **kwargs})
+                for kwargs in split_kwargs
+            ]
+            for i, e in enumerate(dls):
                 # Log stats about the dataloaders
                 ds_len = e.dataset_length
                 dl_len = len(e)
@@ -101,23 +97,47 @@ def learn(
                     f"SETLEN={str(ds_len).zfill(7)} -|-"
                     f"DLDLEN={str(dl_len).zfill(7)}"
                 )
+            return dls
+
+        dataloaders = make_dataloaders()
+
+        dataloaders_2 = []  # to avoid unboundedness
+        if args.linear_probe or args.fine_tuning:
+            dataloaders_2 = make_dataloaders(batch_size=args.ftop_batch_size, num_transforms=1)
 
     # Create an algorithm
     algo = algo_wrapper()
 
     tstart = time.time()
 
+    # Per-run constants, looked up once
+    save_freq = args.save_freq
+    epochs_target = args.epochs
+    # Group by everything except the seed, which is last, hence index -1
+    group = experiment_name.rpartition('.')[0]
+
     # Set up model save directory
     ckpt_dir = Path(args.checkpoint_dir) / experiment_name
-    Path(ckpt_dir).mkdir(parents=True, exist_ok=True)
+    ckpt_dir.mkdir(parents=True, exist_ok=True)
     # Save the model as a dry run, to avoid bad surprises at the end
-    algo.save_to_path(ckpt_dir, xtra="dryrun")
-    logger.info(f"dry run. Saving model @: {ckpt_dir}")
+    # (unless it was already done for this very config in this directory, e.g. when resuming:
+    # the checkpoint to load from is not part of the config, unlike everything else)
+    config = sorted((k, v) for k, v in vars(args).items() if k != 'load_checkpoint')
+    config_hash = hashlib.sha1(repr(config).encode()).hexdigest()[:12]
+    dryrun_marker = ckpt_dir / f"dryrun_{config_hash}.ok"
+    if dryrun_marker.exists():
+        logger.info(f"dry run already done for this config @: {ckpt_dir}")
+    else:
+        algo.save_to_path(ckpt_dir, xtra="dryrun")
+        dryrun_marker.touch()
+        logger.info(f"dry run. Saving model @: {ckpt_dir}")
 
     # Handle timeout signal gracefully
     def timeout(signum, frame):
-        # Save the model
-        algo.save_to_path(ckpt_dir, xtra="timeout")
+        # Save the model, right away: the pending background saves write other files,
+        # and waiting on them could deadlock (if the signal interrupted a submit)
+        # or let the SIGKILL land first
+        algo.save_to_path(ckpt_dir, xtra="timeout", wait_pending=False)
         # No need to log a message, orterun stopped the trace already
         # No need to end the run by hand, SIGKILL is sent by orterun fast enough after SIGTERM
 
@@ -126,26 +146,8 @@ def learn(
     # quickly followed by a SIGKILL signal (Open-MPI impl)
     signal.signal(signal.SIGTERM, timeout)
 
-    # Group by everything except the seed, which is last, hence index -1
-    group = '.'.join(experiment_name.split('.')[:-1])
-
     # Set up wandb
-    while True:
-        try:
-            wandb.init(
-                project=args.wandb_project,
-                name=experiment_name,
-                id=experiment_name,
-                group=group,
-                config=args.__dict__,
-                dir=args.root,
-            )
-            break
-        except Exception:
-            pause = 10
-            logger.info(f"wandb co error. Retrying in {pause} secs.")
-            time.sleep(pause)
-    logger.info("wandb co established!")
+    init_wandb(args, experiment_name, group)
 
     globs = [  # wandb x-axis metrics
         'train',
@@ -159,15 +161,18 @@ def learn(
         wandb.define_metric(f"{glob}/step")
         wandb.define_metric(f"{glob}/*", step_metric=f"{glob}/step")
 
-    while algo.epochs_so_far < args.epochs:
+    # Bounded by the epoch target whether or not the algo increments its counter
+    # (starts past 0 when resuming from a checkpoint)
+    for epoch in range(algo.epochs_so_far, epochs_target):
+        algo.epochs_so_far = epoch
         logger.info("training")
 
-        log_epoch_info(logger, algo.epochs_so_far, args.epochs, tstart)
+        log_epoch_info(logger, epoch, epochs_target, tstart)
 
         algo.train(dataloaders[0], dataloaders[1])
 
-        if algo.epochs_so_far % args.save_freq == 0:
-            algo.save_to_path(ckpt_dir)
+        if algo.epochs_so_far % save_freq == 0:
+            algo.save_to_path(ckpt_dir, blocking=False)
 
     if algo.epochs_so_far > 0:
         # Save once we are done training
@@ -176,6 +181,9 @@ def learn(
         logger.info(f"we're done training. Saving model @: {ckpt_dir}.\nbye.")
 
     if args.linear_probe or args.fine_tuning:
+        # the pretraining dataloaders are not used anymore: release their persistent workers
+        del dataloaders
+
         if args.linear_probe:
             logger.info("linear-probing")
         else:
@@ -185,14 +193,15 @@ def learn(
 
         algo.renew_head()  # also resets the epoch counter!
 
-        while algo.epochs_so_far < args.ftop_epochs:
+        for epoch in range(algo.epochs_so_far, args.ftop_epochs):
+            algo.epochs_so_far = epoch
 
-            log_epoch_info(logger, algo.epochs_so_far, args.ftop_epochs, tstart)
+            log_epoch_info(logger, epoch, args.ftop_epochs, tstart)
 
             algo.ftop_train(dataloaders_2[0], dataloaders_2[1])
 
-            if algo.epochs_so_far % args.save_freq == 0:
-                algo.save_to_path(ckpt_dir, xtra="with_new_head")
+            if algo.epochs_so_far % save_freq == 0:
+                algo.save_to_path(ckpt_dir, xtra="with_new_head", blocking=False)
 
         logger.info("testing")
         algo.ftop_test(dataloaders_2[2])
@@ -205,7 +214,4 @@ def learn(
 
     else:
         logger.info("testing")
-        if args.algo_handle == 'simclr':  # and any future potential contrastive-loss algo
-            algo.test(dataloaders[2], dataloaders[3])
-        else:
-            algo.test(dataloaders[2])
+        algo.test(dataloaders[2])
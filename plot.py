@@ -122,46 +122,47 @@ fig, axs = plt.subplots(
     n_rows, n_cols,
     figsize=(n_cols * unit_size,
              n_rows * unit_size),
+    sharex=True,
+    sharey=True,  # every metric lives in [0, 1]
 )  # everything in one figure
 percs = [float(k) for k in test_results.keys()]
+# gather every value once in an array of shape (len(cs), len(ms), len(percs)), then slice views
+data = np.array([
+    [[test_results[p][c][m] for p in test_results.keys()] for m in ms]
+    for c in cs
+])
 lines = []  # will contain what's needed in the legend
-hline_flag = True
-for c in cs:
-    i, j = 0, 0
-    for k, m in enumerate(ms):
-        axs[i, j].set_title('')
-        axs[i, j].set_xscale("log")
-        axs[i, j].xaxis.set_major_formatter(mtick.PercentFormatter())
-        axs[i, j].set_ylim(ymin=0., ymax=1.)
-        axs[i, j].set_xlabel("percentage of labels available")
-        axs[i, j].set_ylabel(m.replace('_', ' '))
-        axs[i, j].set_yticks(np.arange(0., 1., 0.1))
+for k, m in enumerate(ms[:n_rows * n_cols]):
+    ax = axs.flat[k]
+    # style each subplot once, not once per plotted classifier
+    ax.set(
+        title='',
+        xscale='log',
+        ylim=(0., 1.),
+        xlabel="percentage of labels available",
+        ylabel=m.replace('_', ' '),
+        yticks=np.arange(0., 1., 0.1),
+    )
+    ax.xaxis.set_major_formatter(mtick.PercentFormatter())
 
-        line = axs[i, j].axhline(y=classifier100[m], color='grey')
-        if k == 0 and hline_flag:
-            lines.append(line)
-            hline_flag = False
+    line = ax.axhline(y=classifier100[m], color='grey')
+    if k == 0:
+        lines.append(line)
 
-        line, = axs[i, j].plot(
+    for c_idx, c in enumerate(cs):
+        line, = ax.plot(
             percs,
-            [test_results[k][c][m]
-             for k in test_results.keys()],
+            data[c_idx, k],
             marker='X',
             markersize=12,
             color=colors[c],
         )
         if k == 0:
             lines.append(line)  # for the legend
-        j += 1
-        if j >= n_cols:
-            if i < (n_rows - 1):
-                i += 1
-                j = 0
-            else:
-                break
 # handle the legend
 fig.legend(lines, ['Classifier trained on every labelled pair', *labels])
 fig.savefig("res.png")
+plt.close(fig)  # not needed anymore: release it before building the next one
 
 # ok now we make one figure per percentage
 n_rows, n_cols, unit_size = len(percs), 1, 5  # hps, careful
@@ -178,8 +179,7 @@ for k, p in enumerate(test_results.keys()):
         axs[k].set_ylim(ymin=0., ymax=1.)
         line = axs[k].bar(
             index + (u * width),
-            [test_results[p][c][m]
-             for m in ms],
+            data[u, :, k],
             width,
             label=label,
             color=colors[c],
@@ -195,3 +195,4 @@ for k, p in enumerate(test_results.keys()):
     axs[k].grid(axis='y')  # easier to see the values
 fig.legend(lines, labels, prop={'size': 12})
 fig.savefig("res-bars.png")
+plt.close(fig)
@@ -51,6 +51,8 @@ class Spawner(object):
         self.bool_args = [
             'cuda',
             'fp16',
+            'deterministic',
+            'compile',
             'pretrained_w_imagenet',
             'linear_probe',
             'fine_tuning',
@@ -155,6 +157,14 @@ class Spawner(object):
         }
         if 'truncate_at' in self.config:
             hpmap.update({'truncate_at': self.config['truncate_at']})
+        if 'amp_dtype' in self.config:
+            hpmap.update({'amp_dtype': self.config['amp_dtype']})
+        if 'log_every' in self.config:
+            hpmap.update({'log_every': self.config['log_every']})
+        if 'deterministic' in self.config:
+            hpmap.update({'deterministic': self.config['deterministic']})
+        if 'compile' in self.config:
+            hpmap.update({'compile': self.config['compile']})
 
         algo_handle = hpmap['algo_handle']
         if algo_handle == 'classifier':